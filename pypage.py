@@ -16,14 +16,28 @@
 # limitations under the License.
 
 from __future__ import print_function
-import string, sys, time, os, json
+import string, sys, time, os, json, re, keyword, ast, errno
 
 pypage_version = '2.1.0'
 
+# Define _clock() for measuring elapsed time:
+if hasattr(time, 'perf_counter'):
+    _clock = time.perf_counter
+else:
+    _clock = time.time
+
+# Define _intern() for interning names used as dictionary keys:
+if hasattr(sys, 'intern'):
+    _intern = sys.intern
+else:
+    _intern = intern
+
 class RootNode(object):
     """
     Root node of the abstract syntax tree.
     """
+    __slots__ = ('children',)
+
     def __init__(self):
         self.children = list()
 
@@ -34,6 +48,8 @@ class TextNode(object):
     """
     A leaf node containing text.
     """
+    __slots__ = ('src',)
+
     def __init__(self):
         self.src = str()
 
@@ -62,6 +78,8 @@ class TagNode(object):
         open_delim:  string containig the opening delimiter
         close_delim: string containig the closing delimiter
     """
+    __slots__ = ('src', 'loc')
+
     escape_delims = {('\\' + '{'):'{', ('\\' + '}'):'}'}
 
     def __init__(self, loc):
@@ -72,6 +90,8 @@ class CodeTag(TagNode):
     """
     A leaf node containing Python code.
     """
+    __slots__ = ()
+
     open_delim, close_delim = '{{', '}}'
 
     def __init__(self, loc):
@@ -84,6 +104,8 @@ class CommentTag(TagNode):
     """
     A leaf node containing ignored content.
     """
+    __slots__ = ()
+
     open_delim, close_delim = '{#', '#}'
 
     def __init__(self, loc):
@@ -100,6 +122,8 @@ class BlockTag(TagNode):
     Members:
         children: child nodes belonging to this node
     """
+    __slots__ = ('children',)
+
     open_delim, close_delim = '{%', '%}'
 
     def __init__(self, loc):
@@ -116,6 +140,8 @@ class ConditionalBlock(BlockTag):
     """
     Implements `if`, `elif` and `else` conditional block tags.
     """
+    __slots__ = ('tag_type', 'expr', 'continuation', 'literal_truth')
+
     tag_if = 'if'
     tag_elif = 'elif'
     tag_else = 'else'
@@ -142,6 +168,7 @@ class ConditionalBlock(BlockTag):
             raise ExpressionMissing(self)
 
         self.continuation = None
+        self.literal_truth = literal_truth(self.expr)
 
     def __repr__(self):
         return "%s %s %s:\n" % (self.open_delim, self.src, self.close_delim) + indent(
@@ -149,22 +176,34 @@ class ConditionalBlock(BlockTag):
             '\n' + indent(repr(self.continuation)) if self.continuation else '')
 
     def run(self, pe):
-        output = str()
+        # Walk down the chain of elif/else continuations, rather than
+        # recursing into each one, until a condition holds
+        block = self
+        while block:
+            truth = block.literal_truth
+            if truth is None:
+                truth = pe.raw_eval(block.expr)
 
-        if pe.raw_eval(self.expr):
-            output = exec_tree(self, pe)
-        elif self.continuation:
-            output = self.continuation.run(pe)
+            if truth:
+                return exec_tree(block, pe)
 
-        return output
+            block = block.continuation
+
+        return str()
 
 class ForBlock(BlockTag):
     """
     The for loop tag. {% for ... in ... %}
 
-    The `for` expression is evaluated in/as a generator expression.
+    A loop of the form `for x in <iterable>` iterates over the iterable
+    directly. Any other `for` expression is evaluated in/as a generator
+    expression.
     """
+    __slots__ = ('targets', 'genexpr', 'iterable', 'body_text')
+
     tag_startswith = 'for '
+    simple_for_pattern = re.compile(r'for\s+([A-Za-z_][A-Za-z0-9_]*)\s+in\b(.*)$', re.DOTALL)
+    comp_iter_pattern = re.compile(r'\b(for|if|async)\b')
 
     @staticmethod
     def identify(src):
@@ -176,39 +215,56 @@ class ForBlock(BlockTag):
 
         self.targets = self._find_targets()
         self.genexpr = self._construct_generator_expression()
+        self.iterable = self._find_simple_iterable()
+        self.body_text = None
 
     def run(self, pe):
-        output = str()
+        output = list()
 
         conflicting = set(pe.env.keys()) & set(self.targets)
         backup = { x : pe.env[x] for x in conflicting }
 
-        gen = pe.raw_eval(self.genexpr)
-
-        def get_for_targets():
-            result = next(gen)
+        if self.iterable is not None:
+            # Compile the generator expression all the same, so that any syntax
+            # errors are reported as before, but iterate over the iterable itself
+            cached_compile(self.genexpr, 'eval')
+            gen = iter(pe.raw_eval(self.iterable))
+        else:
+            gen = pe.raw_eval(self.genexpr)
+        single_target = self.targets[0] if len(self.targets) == 1 else None
 
-            if len(self.targets) == 1:
-                return { self.targets[0] : result }
-            else:
-                return dict( zip( self.targets, result ) )
+        # A body of nothing but text renders the same way every iteration,
+        # so it only needs repeating once the number of iterations is known
+        body_text, iterations = self.body_text, 0
 
         while True:
             try:
-                pe.env.update( get_for_targets() )
+                # Bind the targets straight into the environment,
+                # rather than building a new dict every iteration
+                result = next(gen)
+                if single_target is not None:
+                    pe.env[single_target] = result
+                else:
+                    pe.env.update( zip( self.targets, result ) )
 
-                output += exec_tree(self, pe)
+                if body_text is not None:
+                    iterations += 1
+                else:
+                    output.append(exec_tree(self, pe))
 
             except StopIteration:
                 break
 
+        if body_text is not None:
+            output.append(body_text * iterations)
+
         for target in self.targets:
             if target in pe.env:
                 del pe.env[target]
 
         pe.env.update(backup)
 
-        return output
+        return ''.join(output)
 
     def _find_targets(self):
         """
@@ -241,21 +297,46 @@ class ForBlock(BlockTag):
             tokens = tokens[in_index+1:]
 
             target_list = [''.join(c for c in s if c.isalnum() or c=='_') for s in target_list_str.split(',')]
-            target_set = set( filter(lambda s: isidentifier(s), target_list) )
+            target_set = set( filter(isidentifier, target_list) )
             targets |= target_set
 
         if not targets:
             raise IncorrectForTag
 
-        return tuple(sorted(targets))
+        return tuple(_intern(target) for target in sorted(targets))
 
     def _construct_generator_expression(self):
         return "((%s) %s)" % (', '.join(self.targets), self.src)
 
+    def find_body_text(self):
+        """
+        If the body of the loop is nothing but text, return that text.
+        Otherwise, return None. Called once the tree is complete.
+        """
+        if all(isinstance(child, TextNode) for child in self.children):
+            return ''.join(child.src for child in self.children)
+        return None
+
+    def _find_simple_iterable(self):
+        """
+        For a tag of the form `for x in <iterable>`, e.g. `for i in range(3)`,
+        return the <iterable> expression, which can be iterated over directly,
+        without the overhead of resuming a generator for every item.
+        Return None for anything more involved (multiple targets, `if`s, etc.).
+        """
+        match = ForBlock.simple_for_pattern.match(self.src)
+        if match and self.targets == (match.group(1),):
+            iterable = match.group(2)
+            if not ForBlock.comp_iter_pattern.search(iterable):
+                return iterable
+        return None
+
 class WhileBlock(BlockTag):
     """
     The while loop tag. {% while ... %}
     """
+    __slots__ = ('expr', 'dofirst', 'slow')
+
     tag_startswith = 'while '
     loop_time_limit = 2.0 # seconds
 
@@ -286,27 +367,29 @@ class WhileBlock(BlockTag):
             self.slow = False
 
     def run(self, pe):
-        output = str()
+        output = list()
 
         if self.dofirst:
-            output += exec_tree(self, pe)
+            output.append(exec_tree(self, pe))
 
-        loop_start_time = time.time()
+        loop_start_time = _clock()
 
         while pe.raw_eval(self.expr):
-            output += exec_tree(self, pe)
+            output.append(exec_tree(self, pe))
 
-            if not self.slow and time.time() - loop_start_time > WhileBlock.loop_time_limit:
+            if not self.slow and _clock() - loop_start_time > WhileBlock.loop_time_limit:
                 # TODO: more elegant handling
                 print("Loop '%s' terminated." % self.expr, file=sys.stderr)
                 break
 
-        return output
+        return ''.join(output)
 
 class CaptureBlock(BlockTag):
     """
     Capture all content within this tag, and bind it to a variable.
     """
+    __slots__ = ('varname',)
+
     tag_startswith = 'capture '
 
     @staticmethod
@@ -317,7 +400,7 @@ class CaptureBlock(BlockTag):
         super(CaptureBlock, self).__init__(node.loc)
         self.src = node.src.strip()
 
-        self.varname = self.src[len(self.tag_startswith):].strip()
+        self.varname = _intern(self.src[len(self.tag_startswith):].strip())
 
         if not isidentifier(self.varname):
             raise InvalidCaptureBlockVariableName(self.varname)
@@ -331,6 +414,8 @@ class CommentBlock(BlockTag):
     """
     The comment tag. All content within this tag is ignored.
     """
+    __slots__ = ()
+
     tag_startswith = 'comment'
 
     @staticmethod
@@ -358,6 +443,8 @@ class EndBlockTag(BlockTag):
     If the block type name does not match the block it is trying to close,
     a MismatchingEndBlockTag exception will be thrown.
     """
+    __slots__ = ('tag_to_end',)
+
     @staticmethod
     def identify(src):
         "Return `True` if `src` denotes a closing tag."
@@ -478,33 +565,101 @@ def first_true(function, sequence):
 
 def isidentifier(s):
     # As per: https://docs.python.org/2/reference/lexical_analysis.html#identifiers
-    return all( [bool(s) and (s[0].isalpha() or s[0]=='_')] +
-        list(map(lambda c: c.isalnum() or c=='_', s)) )
+    # Every character besides the underscores must be alphanumeric:
+    alnum = s.replace('_', '')
+    return bool(s) and (s[0].isalpha() or s[0]=='_') and (not alnum or alnum.isalnum())
+
+_literal_pattern = re.compile(r'(True|False|None|[-+]?[0-9]+|\'[^\'\\]*\'|"[^"\\]*")$')
+def literal_truth(expr):
+    """
+    If `expr` is a literal (e.g. 'True', '0', or the implied condition of an
+    `else`), return its truth value, as it can be known without running code.
+    Returns None for anything else.
+    """
+    if _literal_pattern.match(expr):
+        try:
+            return bool(ast.literal_eval(expr))
+        except (ValueError, SyntaxError):
+            pass
+    return None
 
 def first_occurrence(text, c):
     "Position of the first occurence of character ``c`` in ``text``."
-    for i in range(len(text)):
-        if text[i] == c:
-            return i
+    i = text.find(c)
+    if i != -1:
+        return i
 
 def last_occurrence(text, c):
     "Position of the last occurence of character ``c`` in ``text``."
-    for i in range(len(text)-1, -1, -1):
-        if text[i] == c:
-            return i
+    i = text.rfind(c)
+    if i != -1:
+        return i
+
+_lex_tables = dict()
+
+def lex_tables():
+    """
+    Return the tag types and lookup tables used by `lex`, as a tuple of
+    (open_delims, blockTagTypes, blockTagKeywords, special_chars). They're only
+    rebuilt when the tag types themselves change (e.g. a new BlockTag subclass
+    is defined).
+    """
+    tagNodeTypes = tuple(TagNode.__subclasses__())
+    blockTagTypes = tuple(BlockTag.__subclasses__())
+
+    key = (tagNodeTypes, blockTagTypes)
+    tables = _lex_tables.get(key)
+    if tables is None:
+        open_delims = { t.open_delim : t for t in tagNodeTypes }
+
+        # Map the leading keyword of each block tag type (e.g. 'for', 'else') to
+        # the type, so most tags are identified with a single lookup. Earlier types
+        # take precedence, as in the `first_true` scan that handles everything else.
+        blockTagKeywords = dict()
+        for t in reversed(blockTagTypes):
+            for word in getattr(t, 'tag_options', [getattr(t, 'tag_startswith', '')]):
+                blockTagKeywords[word.strip()] = t
+
+        # The delimiters the lexer looks for while inside each type of node
+        node_delims = { TextNode : list(open_delims) }
+        for t in tagNodeTypes:
+            node_delims[t] = [t.close_delim] + ([CommentTag.open_delim] if issubclass(t, CommentTag) else [])
+
+        # Inside each type of node, every delimiter and escape sequence that can
+        # occur begins with one of the characters matched by its pattern here
+        special_chars = dict(
+            (node_type, re.compile('[%s]' % re.escape(''.join(
+                sorted(set(delim[0] for delim in delims + list(TagNode.escape_delims)))))))
+            for node_type, delims in node_delims.items())
+
+        tables = (open_delims, blockTagTypes, blockTagKeywords, special_chars)
+        _lex_tables.clear()
+        _lex_tables[key] = tables
+
+    return tables
 
 def lex(src):
     assert isinstance(src, str)
 
-    tagNodeTypes = TagNode.__subclasses__()
-    open_delims = { t.open_delim : t for t in tagNodeTypes }
+    open_delims, blockTagTypes, blockTagKeywords, special_chars = lex_tables()
     comment_tag_depth = 0
 
-    blockTagTypes = BlockTag.__subclasses__()
-
     tokens = list()
     node = None
 
+    # The pieces of source making up the current node, which are joined into
+    # `node.src` once the node is complete, rather than concatenated one by one
+    parts = list()
+
+    # Source without any tags or escapes is a single TextNode
+    if not any(delim in src for delim in open_delims) and not any(
+               escape in src for escape in TagNode.escape_delims):
+        if src:
+            node = TextNode()
+            node.src = src
+            tokens.append(node)
+        return tokens
+
     i = 0
     line_number, newline_position = 1, 0
     while i < len(src) - 1:
@@ -520,17 +675,21 @@ def lex(src):
         #   - Look for any TagNode open_delims
         #   - If there aren't any, create a TextNode
         if not node:
-            if c2 in open_delims.keys():
+            if c2 in open_delims:
                 node = open_delims[c2]((line_number, column_number))
+                parts = list()
                 i += 2
                 continue
             else:
                 node =  TextNode()
+                parts = list()
 
         # If in TextNode, look for open_delims
-        if isinstance(node, TextNode) and c2 in open_delims.keys():
+        if isinstance(node, TextNode) and c2 in open_delims:
+            node.src = ''.join(parts)
             tokens.append(node)
             node = open_delims[c2]( (line_number, column_number) )
+            parts = list()
             if isinstance(node, CommentTag):
                 comment_tag_depth += 1
 
@@ -540,19 +699,25 @@ def lex(src):
         # Handle nested comment tags (e.g. {# ... {# ... #} ... #})
         if isinstance(node, CommentTag) and c2 == CommentTag.open_delim:
             comment_tag_depth += 1
-            node.src += c2
+            parts.append(c2)
 
             i += 2
             continue
 
         # If in TagNode, look for close_delim
         if isinstance(node, TagNode) and c2 == node.close_delim:
+            node.src = ''.join(parts)
+
             if isinstance(node, BlockTag):
                 if '\n' in node.src:
                     # a BlockTag must be on a single line
                     raise MultiLineBlockTag(node)
 
-                nodeType = first_true(lambda t: t.identify(node.src), blockTagTypes)
+                words = node.src.split(None, 1)
+                nodeType = blockTagKeywords.get(words[0] if words else '')
+                if nodeType is None or not nodeType.identify(node.src):
+                    nodeType = first_true(lambda t: t.identify(node.src), blockTagTypes)
+
                 if nodeType == None:
                     raise UnknownTag(node)
                 else:
@@ -563,7 +728,7 @@ def lex(src):
 
                 if comment_tag_depth != 0:
                     # skip this comment close tag
-                    node.src += c2
+                    parts.append(c2)
 
                     i += 2
                     continue
@@ -576,21 +741,39 @@ def lex(src):
 
         # Skip escaped characters
         if c2 in TagNode.escape_delims:
-            node.src += TagNode.escape_delims[c2]
+            parts.append(TagNode.escape_delims[c2])
 
             i += 2
             continue
 
         if i < len(src) - 2:
-            # Consume a character of source
-            node.src += c
-            i += 1
+            # Consume a character of source, together with the run of characters
+            # after it that cannot start a delimiter or an escape sequence
+            match = special_chars[type(node)].search(src, i + 1, len(src) - 2)
+            run_end = match.start() if match else len(src) - 2
+
+            newlines = src.count('\n', i + 1, run_end)
+            if newlines:
+                line_number += newlines
+                newline_position = src.rfind('\n', i + 1, run_end)
+
+            parts.append(src[i:run_end])
+            i = run_end
         else:
             # If we're at the second-to-last character, consume two
-            node.src += c2
+            parts.append(c2)
             i += 2
 
+    if i == len(src) - 1:
+        # The loop leaves the last character over when a delimiter or an
+        # escape sequence ends just before it, so consume it here
+        if not node:
+            node = TextNode()
+            parts = list()
+        parts.append(src[i])
+
     if node:
+        node.src = ''.join(parts)
         if isinstance(node, TextNode):
             tokens.append(node)
             node = None
@@ -599,6 +782,10 @@ def lex(src):
 
     return tokens
 
+def is_whitespace(text):
+    "Whether ``text`` consists of nothing but whitespace (or is empty)."
+    return not text.strip(string.whitespace)
+
 def remove_whitespace_from_tokens(tokens):
     """
     Strip away the leading and trailing whitespace surrounding a tag.
@@ -608,7 +795,7 @@ def remove_whitespace_from_tokens(tokens):
         if isinstance(tokens[i], TagNode):
 
             # Check if the previous token is a TextNode:
-            leading_text, prev_nl_pos = [], None
+            leading_text, prev_nl_pos = '', None
             if i > 0 and isinstance(tokens[i-1], TextNode):
                 prev_nl_pos = last_occurrence(tokens[i-1].src, '\n')
                 if prev_nl_pos != None:
@@ -617,7 +804,7 @@ def remove_whitespace_from_tokens(tokens):
                     leading_text = tokens[i-1].src
 
             # Check if the next token is a TextNode:
-            trailing_text, next_nl_pos = [], None
+            trailing_text, next_nl_pos = '', None
             if i < (len(tokens) - 1) and isinstance(tokens[i+1], TextNode):
                 next_nl_pos = first_occurrence(tokens[i+1].src, '\n')
                 if next_nl_pos != None:
@@ -625,8 +812,8 @@ def remove_whitespace_from_tokens(tokens):
                 else:
                     trailing_text = tokens[i+1].src
 
-            should_strip = all(c in string.whitespace for c in leading_text) and all(
-                               c in string.whitespace for c in trailing_text) and not (
+            should_strip = is_whitespace(leading_text) and is_whitespace(
+                               trailing_text) and not (
                                isinstance(tokens[i], CodeTag) and '\n' not in tokens[i].src )
 
             if should_strip:
@@ -638,7 +825,7 @@ def remove_whitespace_from_tokens(tokens):
 
                 if stripped_prev and i-2 >= 0:
                     if isinstance(tokens[i-1], TextNode) and isinstance(tokens[i-2], TagNode):
-                        if '\n' not in tokens[i-1].src and all(c in string.whitespace for c in tokens[i-1].src):
+                        if '\n' not in tokens[i-1].src and is_whitespace(tokens[i-1].src):
                             tokens[i-1].src = ''
 
             stripped_prev = should_strip
@@ -655,39 +842,44 @@ def prune_tokens(tokens):
     return new_tokens
 
 def build_tree(node, tokens_iterator):
-    try:
-        while True:
-            tok = next(tokens_iterator)
-
-            if isinstance(tok, ConditionalBlock):
-                if tok.tag_type == ConditionalBlock.tag_elif or tok.tag_type == ConditionalBlock.tag_else:
-                    if node.tag_type == ConditionalBlock.tag_if or node.tag_type == ConditionalBlock.tag_elif:
-                        node.continuation = tok
-                        build_tree(tok, tokens_iterator)
-                        return
-                    else:
-                        raise ElifOrElseWithoutIf(tok)
-
-                elif tok.tag_type == ConditionalBlock.tag_else:
-                    return
+    # Keep the nodes being built on an explicit stack, rather than recursing
+    # into every block, so that building the tree doesn't use a Python frame
+    # per level of nesting. (Running the tree, and repr, still recurse.)
+    # The innermost open node is at the top of the stack.
+    stack = [node]
+
+    for tok in tokens_iterator:
+        node = stack[-1]
+
+        if isinstance(tok, ConditionalBlock):
+            if tok.tag_type == ConditionalBlock.tag_elif or tok.tag_type == ConditionalBlock.tag_else:
+                if node.tag_type == ConditionalBlock.tag_if or node.tag_type == ConditionalBlock.tag_elif:
+                    # The continuation takes the place of the node it continues
+                    node.continuation = tok
+                    stack[-1] = tok
+                    continue
+                else:
+                    raise ElifOrElseWithoutIf(tok)
 
-            if isinstance(tok, EndBlockTag):
-                if isinstance(node, BlockTag):
-                    if tok.does_end(node):
+        if isinstance(tok, EndBlockTag):
+            if isinstance(node, BlockTag):
+                if tok.does_end(node):
+                    stack.pop()
+                    if not stack:
                         return
-                    else:
-                        raise MismatchingEndBlockTag(tok, node)
+                    continue
                 else:
-                    raise UnboundEndBlockTag(tok)
+                    raise MismatchingEndBlockTag(tok, node)
+            else:
+                raise UnboundEndBlockTag(tok)
 
-            node.children.append(tok)
+        node.children.append(tok)
 
-            if isinstance(tok, BlockTag):
-                build_tree(tok, tokens_iterator)
+        if isinstance(tok, BlockTag):
+            stack.append(tok)
 
-    except StopIteration:
-        if not isinstance(node, RootNode):
-            raise UnclosedTag(node)
+    if not isinstance(stack[-1], RootNode):
+        raise UnclosedTag(stack[-1])
 
 def parse(src):
     tokens = lex(src)
@@ -698,6 +890,175 @@ def parse(src):
 
     return tree
 
+def walk_blocks(tree):
+    """
+    Yield `tree` and every node with children beneath it (including elif/else
+    continuations), parents before their children. A node's children are only
+    looked at after it has been yielded, so they may be replaced in the meantime.
+    """
+    stack = [tree]
+
+    while stack:
+        node = stack.pop()
+        yield node
+
+        for child in node.children:
+            if isinstance(child, BlockTag):
+                stack.append(child)
+
+            if isinstance(child, ConditionalBlock):
+                continuation = child.continuation
+                while continuation:
+                    stack.append(continuation)
+                    continuation = continuation.continuation
+
+_constant_operand = r"""(?:[-+]?[0-9]+|'[^'\\\n]*'|"[^"\\\n]*")"""
+_constant_code_pattern = re.compile(r'[ \t]*%s(?:[ \t]*\+[ \t]*%s)*[ \t]*\Z' % (_constant_operand, _constant_operand))
+
+def fold_constant_code_tags(tree):
+    """
+    Replace inline code tags that are nothing but literals, or literals added
+    together (e.g. {{ 'a' + 'b' }}), with the text they would always produce,
+    so they aren't evaluated on every run. Only shapes this cheap are folded,
+    since the tag may sit in a branch that never runs. Code that raises is
+    left as is, so the error surfaces at run time.
+    """
+    for node in walk_blocks(tree):
+        for i, child in enumerate(node.children):
+            if isinstance(child, CodeTag) and _constant_code_pattern.match(child.src):
+                try:
+                    result = eval(cached_compile(child.src, 'eval'), dict())
+                    text = str(result) if result else ''
+                except Exception:
+                    continue
+
+                folded = TextNode()
+                folded.src = text
+                node.children[i] = folded
+
+    return tree
+
+def constant_branch(block):
+    """
+    For an if/elif/else chain starting at `block`, whose conditions are all
+    literals up to the first one that holds, return (True, branch), where
+    branch is the block that always runs (or None if none of them ever do).
+    Otherwise, return (False, None).
+    """
+    while block:
+        if block.literal_truth is None:
+            return False, None
+        if block.literal_truth:
+            return True, block
+        block = block.continuation
+
+    return True, None
+
+def splice_constant_conditionals(tree):
+    """
+    Replace if/elif/else chains whose outcome is known in advance
+    (e.g. {% if True %}) with the children of the branch that always runs.
+    """
+    for node in walk_blocks(tree):
+        pending = list(reversed(node.children))
+        children = list()
+
+        while pending:
+            child = pending.pop()
+
+            if isinstance(child, ConditionalBlock):
+                known, branch = constant_branch(child)
+                if known:
+                    if branch:
+                        pending.extend(reversed(branch.children))
+                    continue
+
+            children.append(child)
+
+        node.children = children
+
+    return tree
+
+def drop_comments(tree):
+    """
+    Discard comment tags and comment blocks, which produce no output, so that
+    the text around them can be fused.
+    """
+    for node in walk_blocks(tree):
+        node.children = [child for child in node.children
+                         if not isinstance(child, (CommentTag, CommentBlock))]
+
+    return tree
+
+def fuse_text_nodes(tree):
+    """
+    Merge runs of adjacent TextNodes (e.g. those left by folding constant code
+    tags, splicing out if blocks or dropping comments) into one, and discard
+    empty ones.
+    """
+    for node in walk_blocks(tree):
+        children = list()
+
+        for child in node.children:
+            if isinstance(child, TextNode):
+                if not child.src:
+                    continue
+                if children and isinstance(children[-1], TextNode):
+                    fused = TextNode()
+                    fused.src = children[-1].src + child.src
+                    children[-1] = fused
+                    continue
+
+            children.append(child)
+
+        node.children = children
+
+    return tree
+
+def find_loop_body_texts(tree):
+    """
+    Record the text of every for loop whose body is nothing but text, in its
+    `body_text`, so the loop can repeat it rather than run the body. This must
+    come after any pass that changes the children of a loop.
+    """
+    for node in walk_blocks(tree):
+        if isinstance(node, ForBlock):
+            node.body_text = node.find_body_text()
+
+    return tree
+
+def optimize(tree):
+    """
+    Rewrite a tree returned by `parse`, in place, into one that renders the
+    same output with less work. The result is only meant for running, so it
+    no longer mirrors the source the way the tree printed by --tree does.
+    """
+    fold_constant_code_tags(tree)
+    splice_constant_conditionals(tree)
+    drop_comments(tree)
+    fuse_text_nodes(tree)
+    find_loop_body_texts(tree) # after all passes changing the children of loops
+
+    return tree
+
+_parse_cache = dict()
+parse_cache_size = 128
+
+def cached_parse(src):
+    """
+    Like `parse`, but returns an optimized tree (see `optimize`), and reuses
+    the tree of a recently parsed identical source.
+
+    Execution never modifies a tree, so the same tree can be run any number
+    of times against different environments.
+    """
+    tree = _parse_cache.get(src)
+    if tree is None:
+        if len(_parse_cache) >= parse_cache_size:
+            _parse_cache.clear()
+        tree = _parse_cache[src] = optimize(parse(src))
+    return tree
+
 # Define _escape(str):
 if sys.version_info[0] > 3 or (sys.version_info[0] == 3 and sys.version_info[1] >= 2):
     import html
@@ -706,6 +1067,49 @@ else:
     import cgi
     _escape = cgi.escape
 
+_code_cache = dict()
+code_cache_size = 1024
+
+def cached_compile(code, mode):
+    """
+    Like `compile(code, '<string>', mode)`, but reuses the code object
+    of a recent identical compilation.
+
+    As with `eval` on a string, leading spaces and tabs are ignored in
+    'eval' mode.
+    """
+    key = (code, mode)
+    code_object = _code_cache.get(key)
+    if code_object is None:
+        if len(_code_cache) >= code_cache_size:
+            _code_cache.clear()
+        source = code.lstrip(' \t') if mode == 'eval' else code
+        code_object = _code_cache[key] = compile(source, '<string>', mode)
+    return code_object
+
+_variable_name_pattern = re.compile(r'[ \t]*([A-Za-z_][A-Za-z0-9_]*)\s*$')
+_variable_name_cache = dict()
+
+def variable_name(code):
+    """
+    Return the name if `code` is nothing but a variable name (e.g. ' x '),
+    or None otherwise. Keywords and constants like `None` are not names.
+    """
+    try:
+        return _variable_name_cache[code]
+    except KeyError:
+        pass
+
+    if len(_variable_name_cache) >= code_cache_size:
+        _variable_name_cache.clear()
+
+    match = _variable_name_pattern.match(code)
+    name = _intern(match.group(1)) if match else None
+    if name is not None and (keyword.iskeyword(name) or name in ('True', 'False', 'None')):
+        name = None
+    _variable_name_cache[code] = name
+    return name
+
 class PypageExec(object):
     """
     Execute or evaluate code, while persisting the environment.
@@ -729,11 +1133,11 @@ class PypageExec(object):
 
     def inject(self, filepath):
         source = read_file(filepath)
-        self.output += pypage(source, self.env)
+        self.output.append(pypage(source, self.env))
 
     def include(self, filepath):
         file_contents = read_file(filepath)
-        self.output += file_contents
+        self.output.append(file_contents)
 
     def exists(self, varname):
         return varname in self.env
@@ -759,11 +1163,14 @@ class PypageExec(object):
         end = str( get_kwarg('end', '\n') )
         escape = get_kwarg('escape', False)
 
-        self.output += sep.join(_escape(arg) if escape else str(arg) + end for arg in args)
+        self.output.append(sep.join(_escape(arg) if escape else str(arg) + end for arg in args))
 
     def run(self, code, loc):
         code_lines = code.split('\n')
-        self.output = str()
+
+        # Everything written to output while running the code is collected
+        # here, and joined together once the code has finished running
+        self.output = list()
 
         if len(code_lines) > 1:
             # Determine indentation level
@@ -782,45 +1189,52 @@ class PypageExec(object):
             self._exec(code)
 
             # Add the base indentation to the output
-            self.output = '\n'.join(
+            output = '\n'.join(
                 indentation_chars + output_line if output_line.strip() else output_line
-                    for output_line in self.output.split('\n'))
+                    for output_line in ''.join(self.output).split('\n'))
 
-            return self.output
+            return output
         else:
-            result = eval(code, self.env)
+            result = self.raw_eval(code)
 
             if result:
-                return str(result)
+                # Strings, the most common result, need no conversion
+                return result if type(result) is str else str(result)
             else:
-                # self.output will most likely be an empty string,
+                # self.output will most likely be empty,
                 # unless, write(...) was invoked within the {{...}}
-                return self.output
+                return ''.join(self.output)
 
     def _exec(self, code):
         # Workaround for a bug in early versions of Python 2.7 and PyPy2.7
         # that causes a syntax error: https://bugs.python.org/issue21591
-        exec(code, self.env)
+        exec(cached_compile(code, 'exec'), self.env)
 
     def raw_eval(self, code):
         "Evaluate an expression, and return the result raw (without stringifying it)."
-        return eval(code, self.env)
+        name = variable_name(code)
+        if name is not None and name in self.env:
+            # A lone variable can be looked up without calling eval
+            return self.env[name]
+
+        return eval(cached_compile(code, 'eval'), self.env)
 
 def exec_tree(parent_node, pe):
-    output = str()
+    # Collect the output of each node, and join it all together at the end
+    output = list()
 
     for node in parent_node.children:
 
         if isinstance(node, TextNode):
-            output += node.src
+            output.append(node.src)
 
         elif isinstance(node, CodeTag):
-            output += pe.run(node.src, node.loc)
+            output.append(pe.run(node.src, node.loc))
 
         elif isinstance(node, BlockTag):
-            output += node.run(pe)
+            output.append(node.run(pe))
 
-    return output
+    return ''.join(output)
 
 def pypage(source, seed_env=None, duplicate_env=False):
     """pypage(source) -> output
@@ -829,17 +1243,25 @@ def pypage(source, seed_env=None, duplicate_env=False):
     """
     if seed_env is None:
         seed_env = dict()
-    tree = parse(source)
+    tree = cached_parse(source)
     pe = PypageExec(seed_env, duplicate_env)
     return exec_tree(tree, pe)
 
 def read_file(filepath):
-    if os.path.exists(filepath):
-        with open(filepath, 'r') as source_file:
-            return source_file.read()
-    else:
+    # Just try opening the file, rather than checking that it exists first:
+    try:
+        source_file = open(filepath, 'r')
+    except (IOError, OSError) as error:
+        if error.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+        source_file = None
+
+    if source_file is None:
         raise PypageError("File %s does not exist. CWD: %s" % (repr(filepath), os.getcwd()))
 
+    with source_file:
+        return source_file.read()
+
 __all__ = ['pypage', 'pypage_version', PypageError, PypageSyntaxError]
 
 def main():
@@ -852,9 +1274,8 @@ def main():
     parser.add_argument('--tree', action='store_true', help='print the abstract syntax tree and exit')
     args = parser.parse_args()
 
-    source = sys.stdin.read() if args.source_file == '-' else read_file(args.source_file)
-
     try:
+        source = sys.stdin.read() if args.source_file == '-' else read_file(args.source_file)
         tree = parse(source)
 
         if args.tree:
@@ -866,9 +1287,9 @@ def main():
             data = json.loads(args.data[0])
         pe = PypageExec(data)
 
-        output = exec_tree(tree, pe)
+        output = exec_tree(optimize(tree), pe)
 
-    except PypageSyntaxError as error:
+    except PypageError as error:
         print(error, file=sys.stderr)
         sys.exit(1)
 